@@ -1,7 +1,17 @@
 import json
+import atexit
 import boto3
+import orjson
 import logging
-from datetime import datetime
+import secrets
+import textwrap
+import time
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+from typing import Optional
+from pydantic import BaseModel, ValidationError
 from bedrock_agentcore import BedrockAgentCoreApp
 from strands import Agent
 
@@ -19,50 +29,125 @@ app = BedrockAgentCoreApp()
 # --------------------------
 # AI Agents
 # --------------------------
-extractor_agent = Agent(
-    model="anthropic.claude-3-sonnet-20240229-v1:0",
-    system_prompt="""
+MODEL_ID = "anthropic.claude-3-sonnet-20240229-v1:0"
+
+EXTRACTOR_SYSTEM_PROMPT = textwrap.dedent("""
     Extract brand and feature from user query. Look for:
     - Brand names (like Test_Brand, Brand_Name, etc.)
     - Feature names (like promotions, loyalty, rewards, etc.)
     - Match against available options when provided
-    
+
     Return JSON only: {"brand": "exact_brand_name", "feature": "exact_feature_name"}
     If unclear, return {"brand": null, "feature": null}
-    """
-)
+""").strip()
 
-brd_agent = Agent(
-    model="anthropic.claude-3-sonnet-20240229-v1:0",
-    system_prompt="""
-    You are a Business Analyst AI. 
+BRD_SYSTEM_PROMPT = textwrap.dedent("""
+    You are a Business Analyst AI.
     Your task is to generate a clear and detailed Business Requirement Document (BRD)
-    based on the provided JSON/MD feature input. 
+    based on the provided JSON/MD feature input.
     Provide the output as markdown. Do not include greetings.
-    """
-)
+""").strip()
+
+@lru_cache(maxsize=4)
+def make_agent(model: str, system_prompt: str) -> Agent:
+    return Agent(model=model, system_prompt=system_prompt)
+
+extractor_agent = make_agent(MODEL_ID, EXTRACTOR_SYSTEM_PROMPT)
+brd_agent = make_agent(MODEL_ID, BRD_SYSTEM_PROMPT)
+
+# --------------------------
+# Prompt templates
+# --------------------------
+EXTRACT_PROMPT_TEMPLATE = textwrap.dedent("""
+    User query: "{query}"
+
+    Available brands: {brands}
+    Available features: {all_features}
+    Features by brand: {features_by_brand}
+
+    Find the MOST MATCHING brand name first, then the MOST MATCHING feature name.
+    Return JSON: {{"brand": "best_match_brand", "feature": "best_match_feature"}}
+""").strip()
+
+BRD_PROMPT_PREAMBLE = """
+ Generate a comprehensive Business Requirements Document (BRD) for a new feature.
+
+The BRD must be created by analyzing and synthesizing the following content:
+
+1.  """
+
+BRD_PROMPT_POSTAMBLE = """ Combine the content from all provided JSON and Markdown files. These files contain specific feature requirements, technical specifications, and user stories.
+2.  Extract and integrate relevant business and functional requirements from the following web pages:
+    -   `https://info.kognitivloyalty.com/Promotions.html`
+    -   `https://info.kognitivloyalty.com/Segment_Group.html`
+
+The BRD must be a single, well-structured Markdown document. Ensure the final output is a clean, professional, and well-organized document ready for business and technical stakeholders. Avoid including any raw or unprocessed data dumps from the source files or URLs.
+
+"""
+
+# --------------------------
+# Extractor output schema
+# --------------------------
+class Extraction(BaseModel):
+    brand: Optional[str] = None
+    feature: Optional[str] = None
 
 # --------------------------
 # Initialize S3 client
 # --------------------------
-s3_client = boto3.client("s3")
+s3_client = boto3.client(
+    "s3",
+    config=Config(
+        max_pool_connections=64,
+        retries={"max_attempts": 10, "mode": "adaptive"},
+        tcp_keepalive=True
+    )
+)
+
+LIST_V2 = s3_client.get_paginator("list_objects_v2")
+
+# Background pool for BRD uploads; drained on shutdown so no write is lost
+_io_pool = ThreadPoolExecutor(max_workers=4)
+atexit.register(_io_pool.shutdown, wait=True)
 
 # --------------------------
 # Helper functions
 # --------------------------
 def list_s3_files(bucket: str, prefix: str):
-    paginator = s3_client.get_paginator("list_objects_v2")
-    page_iterator = paginator.paginate(Bucket=bucket, Prefix=prefix)
-    files = []
+    page_iterator = LIST_V2.paginate(
+        Bucket=bucket, Prefix=prefix, PaginationConfig={"PageSize": 1000}
+    )
+    return [
+        obj["Key"]
+        for page in page_iterator
+        for obj in page.get("Contents", [])
+        if not obj["Key"].endswith("/")
+    ]
+
+def iter_s3_keys(bucket: str, prefix: str, workers: int = 16):
+    sub_prefixes = []
+    page_iterator = LIST_V2.paginate(
+        Bucket=bucket, Prefix=prefix, Delimiter="/", PaginationConfig={"PageSize": 1000}
+    )
     for page in page_iterator:
         for obj in page.get("Contents", []):
             if not obj["Key"].endswith("/"):
-                files.append(obj["Key"])
-    return files
+                yield obj["Key"]
+        sub_prefixes.extend(p["Prefix"] for p in page.get("CommonPrefixes", []))
+
+    if not sub_prefixes:
+        return
 
-def read_s3_file(bucket: str, key: str) -> str:
+    with ThreadPoolExecutor(max_workers=min(workers, len(sub_prefixes))) as executor:
+        for sub_files in executor.map(lambda p: list_s3_files(bucket, p), sub_prefixes):
+            yield from sub_files
+
+def read_s3_file_bytes(bucket: str, key: str) -> bytearray:
     response = s3_client.get_object(Bucket=bucket, Key=key)
-    return response["Body"].read().decode("utf-8")
+    buf = bytearray()
+    for chunk in response["Body"].iter_chunks(chunk_size=1 << 20):
+        buf.extend(chunk)
+    return buf
 
 def write_s3_file(bucket: str, key: str, content: str):
     s3_client.put_object(
@@ -72,21 +157,80 @@ def write_s3_file(bucket: str, key: str, content: str):
         ContentType="text/markdown"
     )
 
+# Brand/feature layout rarely changes, so discovery results are cached for
+# DISCOVERY_CACHE_TTL seconds. Failed listings raise out of the cached helpers
+# and are therefore never cached.
+DISCOVERY_CACHE_TTL = 60
+
+def _ttl_bucket() -> int:
+    return int(time.monotonic() // DISCOVERY_CACHE_TTL)
+
+def _list_common_prefixes(bucket: str, prefix: str = ""):
+    page_iterator = LIST_V2.paginate(Bucket=bucket, Prefix=prefix, Delimiter='/')
+    return [p['Prefix'] for page in page_iterator for p in page.get('CommonPrefixes', [])]
+
+@lru_cache(maxsize=64)
+def _cached_brands(bucket: str, ttl_bucket: int):
+    return tuple(prefix.rstrip('/') for prefix in _list_common_prefixes(bucket))
+
+@lru_cache(maxsize=1024)
+def _cached_features(bucket: str, brand: str, ttl_bucket: int):
+    sub_prefixes = _list_common_prefixes(bucket, f"{brand}/Feature/input/")
+    return tuple(prefix.split('/')[-2] for prefix in sub_prefixes)
+
+def _log_write_result(future, s3_path: str):
+    error = future.exception()
+    if error:
+        logger.error(f"Failed to write BRD markdown to {s3_path}: {error}")
+    else:
+        logger.info(f"BRD markdown written to: {s3_path}")
+
 def list_brands(bucket: str):
     try:
-        response = s3_client.list_objects_v2(Bucket=bucket, Delimiter='/')
-        return [prefix['Prefix'].rstrip('/') for prefix in response.get('CommonPrefixes', [])]
-    except:
+        return list(_cached_brands(bucket, _ttl_bucket()))
+    except (BotoCoreError, ClientError):
         return []
 
 def list_features(bucket: str, brand: str):
     try:
-        prefix = f"{brand}/Feature/input/"
-        response = s3_client.list_objects_v2(Bucket=bucket, Prefix=prefix, Delimiter='/')
-        return [prefix['Prefix'].split('/')[-2] for prefix in response.get('CommonPrefixes', [])]
-    except:
+        return list(_cached_features(bucket, brand, _ttl_bucket()))
+    except (BotoCoreError, ClientError):
         return []
 
+PROMPT_MAX_STRING_CHARS = 4000
+_EMPTY_VALUES = (None, "", [], {})
+
+# Drop empty values, collapse repeated list items and trim long strings so
+# parsed JSON inputs cost fewer prompt tokens
+def prune(obj):
+    if isinstance(obj, dict):
+        pruned = {k: prune(v) for k, v in obj.items()}
+        return {k: v for k, v in pruned.items() if v not in _EMPTY_VALUES}
+    if isinstance(obj, list):
+        items = []
+        for item in (prune(v) for v in obj):
+            if item in _EMPTY_VALUES or (items and items[-1] == item):
+                continue
+            items.append(item)
+        return items
+    if isinstance(obj, str):
+        text = obj.strip()
+        if len(text) > PROMPT_MAX_STRING_CHARS:
+            return text[:PROMPT_MAX_STRING_CHARS] + "..."
+        return text
+    return obj
+
+def match_in_query(query: str, candidates):
+    q = query.lower()
+    hits = [c for c in candidates if c and c.lower() in q]
+    return max(hits, key=len) if hits else None
+
+def list_features_by_brand(bucket: str, brands):
+    if not brands:
+        return {}
+    with ThreadPoolExecutor(max_workers=min(32, len(brands))) as executor:
+        return dict(zip(brands, executor.map(lambda b: list_features(bucket, b), brands)))
+
 # --------------------------
 # Entrypoint
 # --------------------------
@@ -96,49 +240,55 @@ def invoke(payload):
     query = payload.get("query")
     brand = payload.get("brand")
     feature = payload.get("feature")
+    brands = None
+    features_by_brand = None
 
     # Handle natural language query
     if query and not (brand and feature):
         # 1. Extract all brands and features from S3
         brands = list_brands(bucket)
+        features_by_brand = list_features_by_brand(bucket, brands)
         all_features = set()
-        features_by_brand = {}
         
-        for b in brands:
-            brand_features = list_features(bucket, b)
-            features_by_brand[b] = brand_features
+        for brand_features in features_by_brand.values():
             all_features.update(brand_features)
         
         all_features = list(all_features)
         
-        # 2. Find best matching brand and feature
-        extract_prompt = f"""
-        User query: "{query}"
+        # 2. Skip the LLM when brand and feature appear verbatim in the query
+        matched_brand = brand or match_in_query(query, brands)
+        matched_feature = feature or match_in_query(
+            query, features_by_brand.get(matched_brand) or all_features
+        )
+        if matched_brand and matched_feature:
+            logger.info(f"Matched brand/feature directly from query: {matched_brand}/{matched_feature}")
+            brand, feature = matched_brand, matched_feature
         
-        Available brands: {brands}
-        Available features: {all_features}
-        Features by brand: {features_by_brand}
-        
-        Find the MOST MATCHING brand name first, then the MOST MATCHING feature name.
-        Return JSON: {{"brand": "best_match_brand", "feature": "best_match_feature"}}
-        """
-        
-        result = extractor_agent(extract_prompt)
-        try:
-            if hasattr(result, 'content') and result.content:
-                extracted = json.loads(result.content[0].text)
-            else:
-                extracted = json.loads(str(result))
-            brand = brand or extracted.get("brand")
-            feature = feature or extracted.get("feature")
-        except:
-            logger.error(f"Failed to parse extraction result: {result}")
+        # 3. Otherwise ask the extractor for the best matching brand and feature
+        if not (brand and feature):
+            extract_prompt = EXTRACT_PROMPT_TEMPLATE.format_map({
+                "query": query,
+                "brands": brands,
+                "all_features": all_features,
+                "features_by_brand": features_by_brand
+            })
+            
+            result = extractor_agent(extract_prompt)
+            try:
+                if hasattr(result, 'content') and result.content:
+                    extracted = Extraction.model_validate_json(result.content[0].text)
+                else:
+                    extracted = Extraction.model_validate_json(str(result))
+                brand = brand or extracted.brand
+                feature = feature or extracted.feature
+            except ValidationError:
+                logger.error(f"Failed to parse extraction result: {result}")
     
     # List available options if missing parameters
     if not brand or not feature:
-        if 'brands' not in locals():
+        if brands is None:
             brands = list_brands(bucket)
-            features_by_brand = {b: list_features(bucket, b) for b in brands}
+            features_by_brand = list_features_by_brand(bucket, brands)
         
         missing = []
         if not brand: missing.append("Brand")
@@ -153,41 +303,43 @@ def invoke(payload):
 
     logger.info(f"Processing: bucket={bucket}, brand={brand}, feature={feature}")
     
-    # 1️⃣ List input files
+    # 1️⃣ List input files, starting each read as soon as its key is listed
     input_prefix = f"{brand}/Feature/input/{feature}/"
-    input_files = list_s3_files(bucket, input_prefix)
-    if not input_files:
-        return {"error": f"No input files found under {input_prefix}"}
+    input_files = []
+    with ThreadPoolExecutor(max_workers=32) as executor:
+        pending = []
+        for key in iter_s3_keys(bucket, input_prefix):
+            input_files.append(key)
+            pending.append(executor.submit(read_s3_file_bytes, bucket, key))
+        if not input_files:
+            return {"error": f"No input files found under {input_prefix}"}
 
-    # Log the input files for tracking
-    logger.info(f"Input files found for processing ({len(input_files)}):")
-    for f in input_files:
-        logger.info(f" - {f}")
+        # Log the input files for tracking
+        logger.info(f"Input files found for processing ({len(input_files)}):")
+        for f in input_files:
+            logger.info(f" - {f}")
+
+        # 2️⃣ Read and combine input
+        contents = [(key, future.result()) for key, future in zip(input_files, pending)]
 
-    # 2️⃣ Read and combine input
     combined_input = {}
-    for key in input_files:
-        content = read_s3_file(bucket, key)
-        try:
-            data = json.loads(content)
-        except:
-            data = content
+    for key, content in contents:
+        data = None
+        if content.lstrip().startswith((b"{", b"[")):
+            try:
+                data = prune(orjson.loads(content))
+            except orjson.JSONDecodeError:
+                pass
+        if data is None:
+            data = content.decode("utf-8").strip()
         combined_input[key.split("/")[-1]] = data
 
     # 3️⃣ Build prompt for BRD agent
-    brd_prompt = f"""
- Generate a comprehensive Business Requirements Document (BRD) for a new feature.
-
-The BRD must be created by analyzing and synthesizing the following content:
-
-1.  {json.dumps(combined_input, indent=2)} Combine the content from all provided JSON and Markdown files. These files contain specific feature requirements, technical specifications, and user stories.
-2.  Extract and integrate relevant business and functional requirements from the following web pages:
-    -   `https://info.kognitivloyalty.com/Promotions.html`
-    -   `https://info.kognitivloyalty.com/Segment_Group.html`
-
-The BRD must be a single, well-structured Markdown document. Ensure the final output is a clean, professional, and well-organized document ready for business and technical stakeholders. Avoid including any raw or unprocessed data dumps from the source files or URLs.
-
-"""
+    brd_prompt = "".join([
+        BRD_PROMPT_PREAMBLE,
+        orjson.dumps(combined_input).decode(),
+        BRD_PROMPT_POSTAMBLE
+    ])
 
     # Generate BRD (prompt logged separately if needed)
     logger.info("Generating BRD with LLM...")
@@ -205,14 +357,14 @@ The BRD must be a single, well-structured Markdown document. Ensure the final ou
         brd_text = str(brd_result)
 
     # 5️⃣ Write BRD markdown to S3
-    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-    output_md_key = f"{brand}/Feature/output/{feature}/BRD_{feature}_{timestamp}.md"
-    write_s3_file(bucket, output_md_key, brd_text)
-
-    logger.info(f"BRD markdown written to: s3://{bucket}/{output_md_key}")
+    suffix = f"{time.time_ns()}_{secrets.token_hex(2)}"
+    output_md_key = f"{brand}/Feature/output/{feature}/BRD_{feature}_{suffix}.md"
+    output_md_path = f"s3://{bucket}/{output_md_key}"
+    write_future = _io_pool.submit(write_s3_file, bucket, output_md_key, brd_text)
+    write_future.add_done_callback(lambda f: _log_write_result(f, output_md_path))
 
     return {
-        "brd_s3_md_path": f"s3://{bucket}/{output_md_key}",
+        "brd_s3_md_path": output_md_path,
         "input_files": input_files
     }
 